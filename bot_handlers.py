@@ -8,35 +8,38 @@ DEFAULT_LANG = "uz"
 TIME_CHOICES = ["08:00", "12:00", "18:00", "22:00"]
 
 # --- Helpers ---
-async def _get_user_prefs(chat_id):
-    # should return (lang_code, voice_enabled)
-    try:
-        prefs = await dbmod.get_user_prefs(chat_id)
-        if prefs:
-            return prefs[0] or DEFAULT_LANG, bool(prefs[1])
-    except Exception:
-        pass
-    return DEFAULT_LANG, True
+def _texts(ctx):
+    return lang.TEXT.get(ctx.language, lang.TEXT[DEFAULT_LANG])
+
+def _flush_first(ctx, send):
+    # pending writes hit the DB before anything goes out, so a quick follow-up update sees them
+    async def wrapped(*args, **kwargs):
+        await ctx.flush()
+        return await send(*args, **kwargs)
+    return wrapped
 
 # --- Message handler ---
 async def handle_message(update, send_message, send_voice):
     msg = update.get("message", {})
     chat = msg.get("chat", {})
-    chat_id = chat.get("id")
-    text = (msg.get("text") or "").strip()
-
-    # ensure user in DB
+    # user row, prefs and state in one query; writes flushed once, before the first send
+    if chat.get("id") is None:
+        return
+    ctx = await dbmod.load_context(chat.get("id"), chat.get("first_name", ""))
     try:
-        await dbmod.ensure_user(chat_id, chat.get("first_name", ""))
-    except Exception:
-        pass
+        await _on_message(ctx, msg, _flush_first(ctx, send_message), _flush_first(ctx, send_voice))
+    finally:
+        await ctx.flush()
+
+async def _on_message(ctx, msg, send_message, send_voice):
+    chat_id = ctx.telegram_id
+    text = (msg.get("text") or "").strip()
+    lang_code, voice_on = ctx.language, ctx.voice_enabled
+    T = _texts(ctx)
 
     # /start handling (greet only first time: if user has no reminders)
     if text.startswith("/start"):
-        meds = await dbmod.list_reminders_for_chat(chat_id)
-        lang_code, voice_on = await _get_user_prefs(chat_id)
-        T = lang.TEXT.get(lang_code, lang.TEXT[DEFAULT_LANG])
-        if not meds:
+        if not ctx.reminder_count:
             await send_message(chat_id, T["greeting"] + "\n" + T["start_menu"], reply_markup=ui.main_menu(lang_code))
             if voice_on:
                 await send_voice(chat_id, T["greeting"], lang_code=lang_code)
@@ -45,10 +48,10 @@ async def handle_message(update, send_message, send_voice):
         return
 
     # If user sending name while in "awaiting_med_name" state
-    state, temp = await dbmod.get_state(chat_id)
+    state, temp = ctx.state, ctx.temp_data
     if state == "awaiting_med_name":
         title = text
-        await dbmod.set_state(chat_id, "awaiting_med_time", {"title": title})
+        ctx.set_state("awaiting_med_time", {"title": title})
         # show time choices
         kb = {"inline_keyboard": [[{"text": t, "callback_data": f"time_{t}"}] for t in TIME_CHOICES] + [[{"text":"🕓 Boshqa vaqt kiritish","callback_data":"custom_time"}]]}
         await send_message(chat_id, "⏰ Qachon ichasiz? Tanlang yoki 'Boshqa vaqt' tugmasi orqali kiriting.", reply_markup=kb)
@@ -58,36 +61,39 @@ async def handle_message(update, send_message, send_voice):
     if state == "awaiting_custom_time":
         if re.match(r'^(?:[01]\d|2[0-3]):[0-5]\d$', text):
             title = (temp or {}).get("title", "NoName")
-            await dbmod.add_reminder(chat_id, title, text, "daily")
-            await dbmod.clear_state(chat_id)
-            lang_code, voice_on = await _get_user_prefs(chat_id)
-            T = lang.TEXT.get(lang_code, lang.TEXT[DEFAULT_LANG])
+            ctx.add_reminder(title, text, "daily")
+            ctx.clear_state()
             msg = T["added"].format(title=title, time=text, recurring="daily")
             await send_message(chat_id, msg)
             if voice_on:
                 await send_voice(chat_id, msg, lang_code=lang_code)
         else:
-            lang_code, _ = await _get_user_prefs(chat_id)
-            T = lang.TEXT.get(lang_code, lang.TEXT[DEFAULT_LANG])
             await send_message(chat_id, T["ask_custom_time"])
         return
 
     # fallback: help hint
-    await send_message(chat_id, "ℹ️ Buyruqni tanlang yoki menyudan foydalaning.", reply_markup=ui.main_menu(await _get_user_prefs(chat_id)[0]))
+    await send_message(chat_id, "ℹ️ Buyruqni tanlang yoki menyudan foydalaning.", reply_markup=ui.main_menu(lang_code))
 
 # --- Callback handler ---
 async def handle_callback(callback, send_message, send_voice):
-    cq = callback
+    chat = callback.get("message",{}).get("chat",{})
+    if chat.get("id") is None:
+        return
+    ctx = await dbmod.load_context(chat.get("id"), callback.get("from",{}).get("first_name", ""))
+    try:
+        await _on_callback(ctx, callback, _flush_first(ctx, send_message), _flush_first(ctx, send_voice))
+    finally:
+        await ctx.flush()
+
+async def _on_callback(ctx, cq, send_message, send_voice):
     data = cq.get("data","")
-    msg = cq.get("message",{})
-    chat = msg.get("chat",{})
-    chat_id = chat.get("id")
-    lang_code, voice_on = await _get_user_prefs(chat_id)
-    T = lang.TEXT.get(lang_code, lang.TEXT[DEFAULT_LANG])
+    chat_id = ctx.telegram_id
+    lang_code, voice_on = ctx.language, ctx.voice_enabled
+    T = _texts(ctx)
 
     # --- main menu buttons (names aligned to ui.main_menu) ---
     if data == "add_medication":
-        await dbmod.set_state(chat_id, "awaiting_med_name", {})
+        ctx.set_state("awaiting_med_name", {})
         await send_message(chat_id, T["ask_med_name"])
         return
 
@@ -96,13 +102,12 @@ async def handle_callback(callback, send_message, send_voice):
         if not meds:
             await send_message(chat_id, T["no_meds"])
         else:
-            lines = [f\"{r['id']}: {r['title']} — {r['time']}\" for r in meds]
-            await send_message(chat_id, "📋 " + "\\n".join(lines))
+            lines = [f"{r['id']}: {r['title']} — {r['time']}" for r in meds]
+            await send_message(chat_id, "📋 " + "\n".join(lines))
         return
 
     if data == "show_report":
-        meds = await dbmod.list_reminders_for_chat(chat_id)
-        await send_message(chat_id, T["report"].format(total=len(meds)))
+        await send_message(chat_id, T["report"].format(total=ctx.reminder_count))
         return
 
     if data == "settings_menu":
@@ -112,13 +117,13 @@ async def handle_callback(callback, send_message, send_voice):
     # --- settings actions ---
     if data == "set_lang_uz" or data == "set_lang_ru" or data == "set_lang_en":
         new_lang = data.split("_")[-1]
-        await dbmod.set_user_prefs(chat_id, language=new_lang)
+        ctx.set_prefs(language=new_lang)
         await send_message(chat_id, T["lang_set"].format(lang=new_lang))
         return
 
     if data == "toggle_voice":
-        current = (await dbmod.get_user_prefs(chat_id))[1]
-        await dbmod.set_user_prefs(chat_id, voice_enabled=0 if current else 1)
+        current = ctx.voice_enabled
+        ctx.set_prefs(voice_enabled=not current)
         await send_message(chat_id, T["voice_off"] if current else T["voice_on"])
         return
 
@@ -133,14 +138,13 @@ async def handle_callback(callback, send_message, send_voice):
     # --- time choices ---
     if data.startswith("time_"):
         time_chosen = data.split("_",1)[1]
-        state, temp = await dbmod.get_state(chat_id)
-        title = (temp or {}).get("title")
+        title = (ctx.temp_data or {}).get("title")
         if not title:
-            await dbmod.set_state(chat_id, "awaiting_med_name", {})
+            ctx.set_state("awaiting_med_name", {})
             await send_message(chat_id, T["ask_med_name"])
             return
-        await dbmod.add_reminder(chat_id, title, time_chosen, "daily")
-        await dbmod.clear_state(chat_id)
+        ctx.add_reminder(title, time_chosen, "daily")
+        ctx.clear_state()
         msg = T["added"].format(title=title, time=time_chosen, recurring="daily")
         await send_message(chat_id, msg)
         if voice_on:
@@ -148,16 +152,15 @@ async def handle_callback(callback, send_message, send_voice):
         return
 
     if data == "custom_time":
-        state, temp = await dbmod.get_state(chat_id)
-        await dbmod.set_state(chat_id, "awaiting_custom_time", temp or {})
+        ctx.set_state("awaiting_custom_time", ctx.temp_data or {})
         await send_message(chat_id, T["ask_custom_time"])
         return
 
     # --- delete ---
     if data.startswith("delete_"):
         rid = int(data.split("_",1)[1])
-        await dbmod.delete_reminder(rid)
-        await send_message(chat_id, T["confirm_delete"])
+        deleted = await dbmod.delete_reminder(rid, chat_id)
+        await send_message(chat_id, T["confirm_delete"] if deleted else T["no_meds"])
         return
 
     # fallback
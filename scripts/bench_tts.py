@@ -0,0 +1,38 @@
+# Compare synthesis latency (incl. Opus encoding) and output size of the TTS backends: python scripts/bench_tts.py [runs] [lang ...]
+import sys, time, statistics
+sys.path.insert(0, '.')
+from utils import voice
+
+PHRASES = {
+    'uz': "Paracetamolni soat sakkizda iching.",
+    'ru': "Примите парацетамол в восемь часов.",
+    'en': "Take paracetamol at eight o'clock.",
+}
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+langs = sys.argv[2:] or ['uz', 'ru']
+
+for lang in langs:
+    text = PHRASES.get(lang, PHRASES['en'])
+    for name, backend in voice.BACKENDS.items():
+        if not backend.available(lang):
+            print(f"{lang:3} {name:7} unavailable")
+            continue
+        times, size, opus, errors = [], 0, 0, 0
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            try:
+                audio = backend.synthesize(text, lang)
+                size = len(audio)
+                if voice.FFMPEG_BIN:
+                    opus = len(voice.to_opus(audio, backend.fmt))
+            except Exception as e:
+                errors += 1
+                print(f"{lang:3} {name:7} error: {e}")
+                continue
+            times.append((time.perf_counter() - t0) * 1000)
+        if not times:
+            continue
+        times.sort()
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        print(f"{lang:3} {name:7} runs={len(times)} errors={errors} mean={statistics.mean(times):.1f}ms "
+              f"p50={statistics.median(times):.1f}ms p95={p95:.1f}ms {backend.fmt}_bytes={size} opus_bytes={opus}")
@@ -1,4 +1,4 @@
-
 from utils.csv_tools import export_reminders_csv
-export_reminders_csv('data/pillbot.db', 'data/reminders_export.csv')
+# reads every shard (DB_SHARDS / DB_SHARD_PATTERN)
+export_reminders_csv(out_path='data/reminders_export.csv')
 print('Exported to data/reminders_export.csv')
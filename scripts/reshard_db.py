@@ -0,0 +1,13 @@
+# Re-shard the database: python scripts/reshard_db.py <shards> [dest_pattern] [src ...]
+# Sources default to the current layout (DB_SHARDS); then restart with DB_SHARDS=<shards>.
+# Reminder ids are renumbered, so ids users saw earlier (and old delete_<id> buttons) stop matching.
+import sys
+sys.path.insert(0, '.')
+from utils import dbmod
+from utils.shard_tools import reshard
+
+shards = int(sys.argv[1])
+pattern = sys.argv[2] if len(sys.argv) > 2 else None
+sources = sys.argv[3:] or dbmod.all_paths()
+counts = reshard(sources, shards, pattern)
+print('Resharded', ', '.join(sources), 'into', shards, 'shards:', counts)
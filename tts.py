@@ -1,10 +1,13 @@
-from gtts import gTTS
 import os
+from utils import voice
 
-def generate_tts(text, filename="voice.mp3", lang="uz"):
+def generate_tts(text, filename="voice.ogg", lang="uz"):
+    # the extension follows the actual encoding (ogg, or mp3 when ffmpeg is missing)
     try:
-        tts = gTTS(text=text, lang=lang)
-        tts.save(filename)
+        audio, ext = voice.render(text, lang)
+        filename = f"{os.path.splitext(filename)[0]}.{ext}"
+        with open(filename, "wb") as f:
+            f.write(audio)
         return filename
     except Exception as e:
         print("TTS error:", e)
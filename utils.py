@@ -1,11 +0,0 @@
-import logging
-
-def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler("pillbot.log"),
-            logging.StreamHandler()
-        ]
-    )
@@ -1 +1,2 @@
-from . import db, scheduler, voice, ui, csv_tools
+from . import db, scheduler, voice, ui, csv_tools, shard_tools, logs, ratelimit, broadcast
+from .logs import setup_logging
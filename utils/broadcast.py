@@ -0,0 +1,198 @@
+import os, json, time, uuid, asyncio, logging
+import aiohttp, aiosqlite
+from . import dbmod, voice, ratelimit
+from .ratelimit import bot_limiter
+
+log = logging.getLogger("pillbot.broadcast")
+JOBS_DIR = "data/broadcasts"
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+# recipients are paged by id; the cursor is persisted after every batch
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 200))
+# an uploaded voice note comes back under one of these, depending on how Telegram classified the file
+FILE_KEYS = ("voice", "audio", "document")
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def save_job(job):
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job["updated_at"] = time.time()
+    tmp = _job_path(job["id"]) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, _job_path(job["id"]))
+
+def load_job(job_id):
+    try:
+        with open(_job_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def list_jobs():
+    if not os.path.isdir(JOBS_DIR):
+        return []
+    jobs = [load_job(fn[:-5]) for fn in os.listdir(JOBS_DIR) if fn.endswith(".json")]
+    return sorted((j for j in jobs if j), key=lambda j: j["created_at"])
+
+def create_job(text, with_voice=False, language=None, timezone=None):
+    # text is a string or a {lang: text} dict; language/timezone filter the users table
+    job = dict(id=uuid.uuid4().hex[:12], text=text, voice=bool(with_voice), language=language, timezone=timezone,
+               status="running", cursor={}, sent=0, blocked=0, failed=0, file_ids={},
+               created_at=time.time(), finished_at=None)
+    save_job(job)
+    return job
+
+async def iter_recipients(shard, after_id=0, language=None, timezone=None, batch=BROADCAST_BATCH):
+    # keyset pagination over users so only one batch is ever in memory
+    where, args = ["id>?"], [after_id]
+    if language:
+        where.append("language=?")
+        args.append(language)
+    if timezone:
+        where.append("timezone=?")
+        args.append(timezone)
+    sql = f"SELECT id, telegram_id, language FROM users WHERE {' AND '.join(where)} ORDER BY id LIMIT ?"
+    while True:
+        async with aiosqlite.connect(dbmod.shard_path(shard)) as db:
+            cur = await db.execute(sql, (*args, batch))
+            rows = await cur.fetchall()
+        if not rows:
+            return
+        yield rows
+        args[0] = rows[-1][0]
+
+class Broadcast:
+    def __init__(self, job, bot_api):
+        self.job = job
+        self.bot_api = bot_api
+        # shared with every other job and the reminder dispatcher
+        self.limiter = bot_limiter
+        self.task = None
+        self.workers = asyncio.Semaphore(BROADCAST_WORKERS)
+        self.audio = {}
+        self.audio_lock = asyncio.Lock()
+        self.cancelled = False
+
+    def _text_for(self, lang_code):
+        text = self.job["text"]
+        if isinstance(text, dict):
+            return text.get(lang_code) or text.get("uz") or next(iter(text.values()))
+        return text
+
+    async def _audio_for(self, lang_code):
+        # synthesized once per language for the whole job
+        async with self.audio_lock:
+            if lang_code not in self.audio:
+                self.audio[lang_code] = await voice.render_async(self._text_for(lang_code), lang_code)
+            return self.audio[lang_code]
+
+    async def _call(self, session, method, payload=None, form=None):
+        # returns "sent", "blocked" or "failed"; 429s are retried by limited_call. Only connection errors
+        # are retried here: the request never left, so a resend cannot deliver the message twice.
+        async def post():
+            for attempt in range(ratelimit.MAX_RETRIES):
+                kwargs = {"json": payload} if form is None else {"data": form()}
+                try:
+                    async with session.post(f"{self.bot_api}/{method}", timeout=aiohttp.ClientTimeout(total=20), **kwargs) as resp:
+                        return await resp.json(content_type=None)
+                except aiohttp.ClientConnectorError as e:
+                    log.warning("broadcast %s %s connect error: %s", self.job["id"], method, e)
+                    await asyncio.sleep(2 ** attempt)
+            return {"ok": False, "description": "could not connect"}
+        try:
+            data = await ratelimit.limited_call(post, self.limiter)
+        except Exception as e:
+            log.warning("broadcast %s %s error: %r", self.job["id"], method, e)
+            return "failed", None
+        if data.get("ok"):
+            return "sent", data.get("result")
+        if data.get("error_code") == 403:
+            return "blocked", None
+        return "failed", None
+
+    async def _send_voice(self, session, chat_id, lang_code):
+        file_id = self.job["file_ids"].get(lang_code)
+        if file_id:
+            return await self._call(session, "sendVoice", payload={"chat_id": chat_id, "voice": file_id})
+        audio, ext = await self._audio_for(lang_code)
+        def form():
+            data = aiohttp.FormData()
+            data.add_field("chat_id", str(chat_id))
+            data.add_field("voice", audio, filename=f"broadcast.{ext}", content_type=voice.MIME[ext])
+            return data
+        status, result = await self._call(session, "sendVoice", form=form)
+        if status == "sent":
+            # later recipients reuse the uploaded file instead of re-sending the bytes
+            sent = next((result[k] for k in FILE_KEYS if k in result), None)
+            if sent:
+                self.job["file_ids"].setdefault(lang_code, sent["file_id"])
+        return status, result
+
+    async def _deliver(self, session, chat_id, lang_code):
+        async with self.workers:
+            lang_code = lang_code or "uz"
+            status, _ = await self._call(session, "sendMessage", payload={"chat_id": chat_id, "text": self._text_for(lang_code)})
+            if status == "sent" and self.job["voice"]:
+                try:
+                    await self._send_voice(session, chat_id, lang_code)
+                except Exception as e:
+                    log.warning("broadcast %s voice to %s failed: %s", self.job["id"], chat_id, e)
+            self.job[status] += 1
+
+    async def run(self):
+        job = self.job
+        log.info("Broadcast %s started (sent=%d so far)", job["id"], job["sent"])
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=BROADCAST_WORKERS)) as session:
+            for shard in range(dbmod.DB_SHARDS):
+                after = job["cursor"].get(str(shard), 0)
+                async for rows in iter_recipients(shard, after, job["language"], job["timezone"]):
+                    await asyncio.gather(*(self._deliver(session, tid, lc) for _, tid, lc in rows))
+                    job["cursor"][str(shard)] = rows[-1][0]
+                    save_job(job)
+                    if self.cancelled:
+                        job["status"] = "cancelled"
+                        save_job(job)
+                        return job
+        job["status"] = "done"
+        job["finished_at"] = time.time()
+        save_job(job)
+        log.info("Broadcast %s done: sent=%d blocked=%d failed=%d", job["id"], job["sent"], job["blocked"], job["failed"])
+        return job
+
+_running = {}
+
+def start(job, bot_api):
+    # one task per job id; a job still winding down after cancel() is simply kept going
+    b = _running.get(job["id"])
+    if b and not b.task.done():
+        b.cancelled = False
+        b.job["status"] = "running"
+        return b
+    b = Broadcast(job, bot_api)
+    b.task = asyncio.create_task(b.run())
+    _running[job["id"]] = b
+    def done(t):
+        if _running.get(job["id"]) is b:
+            _running.pop(job["id"])
+        if not t.cancelled() and t.exception():
+            log.error("Broadcast %s crashed", job["id"], exc_info=t.exception())
+    b.task.add_done_callback(done)
+    return b
+
+def progress(job_id):
+    b = _running.get(job_id)
+    return b.job if b else load_job(job_id)
+
+def cancel(job_id):
+    b = _running.get(job_id)
+    if b:
+        b.cancelled = True
+    return b is not None
+
+def resume_all(bot_api):
+    # restart jobs interrupted by a restart; they continue from their saved cursor
+    jobs = [j for j in list_jobs() if j["status"] == "running"]
+    for job in jobs:
+        start(job, bot_api)
+    return jobs
@@ -1,12 +1,17 @@
-
 import csv, sqlite3
-def export_reminders_csv(db_path, out_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute('SELECT id, user_id, title, time, recurring FROM reminders')
-    rows = cur.fetchall()
+from . import dbmod
+
+def export_reminders_csv(db_path=None, out_path='data/reminders_export.csv'):
+    # db_path=None exports every shard; ids are the global reminder ids the bot uses
+    if db_path and dbmod.DB_SHARDS > 1:
+        raise ValueError("DB_SHARDS>1: reminder ids are per shard, export all shards with db_path=None")
+    paths = [db_path] if db_path else dbmod.all_paths()
     with open(out_path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(['id','user_id','title','time','recurring'])
-        writer.writerows(rows)
-    conn.close()
+        writer.writerow(['id','telegram_id','title','time','recurring'])
+        for shard, path in enumerate(paths):
+            conn = sqlite3.connect(path)
+            cur = conn.execute('SELECT r.id, u.telegram_id, r.title, r.time, r.recurring FROM reminders r '
+                               'JOIN users u ON u.id=r.user_id ORDER BY r.id')
+            writer.writerows((dbmod._global_id(rid, shard), *rest) for rid, *rest in cur)
+            conn.close()
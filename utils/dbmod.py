@@ -1,6 +1,13 @@
 
-import aiosqlite, os, datetime, json
+import aiosqlite, asyncio, os, datetime, json, zlib, logging, functools
+import pytz
+log = logging.getLogger("pillbot.db")
 DB = "data/pillbot.db"
+# optional hash sharding by telegram_id: DB_SHARDS=1 keeps everything in DB
+DB_SHARDS = max(1, int(os.getenv("DB_SHARDS", 1)))
+DB_SHARD_PATTERN = os.getenv("DB_SHARD_PATTERN", "data/pillbot-{shard}.db")
+# stored on every new user; reminder times are matched in each user's own timezone
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Tashkent")
 SCHEMA = '''
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,25 +32,52 @@ CREATE TABLE IF NOT EXISTS user_state (
     temp_data TEXT,
     updated_at TEXT
 );
+CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders(time);
+CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id);
+CREATE INDEX IF NOT EXISTS idx_users_timezone ON users(timezone);
 '''.strip()
 
-async def ensure_schema(path=DB):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    async with aiosqlite.connect(path) as db:
-        for stmt in SCHEMA.split(';'):
-            s = stmt.strip()
-            if s:
-                await db.execute(s)
-        await db.commit()
+def shard_of(telegram_id, shards=None):
+    return zlib.crc32(str(telegram_id).encode()) % (shards or DB_SHARDS)
+
+def shard_path(shard, shards=None):
+    if (shards or DB_SHARDS) == 1:
+        return DB
+    return DB_SHARD_PATTERN.format(shard=shard)
+
+def db_for(telegram_id):
+    return shard_path(shard_of(telegram_id))
+
+def all_paths():
+    return [shard_path(i) for i in range(DB_SHARDS)]
+
+# reminder ids are made global by folding the shard number in; identity when unsharded
+def _global_id(local_id, shard):
+    return local_id * DB_SHARDS + shard
+
+def _split_id(reminder_id):
+    return reminder_id % DB_SHARDS, reminder_id // DB_SHARDS
+
+async def ensure_schema(path=None):
+    for p in ([path] if path else all_paths()):
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        async with aiosqlite.connect(p) as db:
+            # WAL lets dispatch reads proceed while the shard's writer commits
+            await db.execute("PRAGMA journal_mode=WAL")
+            for stmt in SCHEMA.split(';'):
+                s = stmt.strip()
+                if s:
+                    await db.execute(s)
+            await db.commit()
 
 async def ensure_user(telegram_id, name=None):
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         cur = await db.execute("SELECT id FROM users WHERE telegram_id=?", (telegram_id,))
         row = await cur.fetchone()
         if row:
             return row[0]
         now = datetime.datetime.utcnow().isoformat()
-        await db.execute("INSERT INTO users (telegram_id,name,created_at) VALUES (?,?,?)", (telegram_id, name or '', now))
+        await db.execute("INSERT INTO users (telegram_id,name,timezone,created_at) VALUES (?,?,?,?)", (telegram_id, name or '', DEFAULT_TIMEZONE, now))
         await db.commit()
         cur = await db.execute("SELECT id FROM users WHERE telegram_id=?", (telegram_id,))
         row = await cur.fetchone()
@@ -53,13 +87,13 @@ async def ensure_user(telegram_id, name=None):
 async def set_state(telegram_id, state, temp_data=None):
     now = datetime.datetime.utcnow().isoformat()
     td = json.dumps(temp_data) if temp_data is not None else None
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         await db.execute("INSERT OR REPLACE INTO user_state (user_id,state,temp_data,updated_at) VALUES ((SELECT id FROM users WHERE telegram_id=?),?,?,?)",
                          (telegram_id, state, td, now))
         await db.commit()
 
 async def get_state(telegram_id):
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         cur = await db.execute("SELECT state,temp_data FROM user_state WHERE user_id=(SELECT id FROM users WHERE telegram_id=?)", (telegram_id,))
         row = await cur.fetchone()
         if not row:
@@ -69,31 +103,71 @@ async def get_state(telegram_id):
         return state, td
 
 async def clear_state(telegram_id):
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         await db.execute("DELETE FROM user_state WHERE user_id=(SELECT id FROM users WHERE telegram_id=?)", (telegram_id,))
         await db.commit()
 
 async def add_reminder(telegram_id, title, time_str, recurring=None):
     user_id = await ensure_user(telegram_id)
     now = datetime.datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB) as db:
+    shard = shard_of(telegram_id)
+    async with aiosqlite.connect(shard_path(shard)) as db:
         cur = await db.execute("INSERT INTO reminders (user_id,title,time,recurring,created_at) VALUES (?,?,?,?,?)", (user_id, title, time_str, recurring, now))
         await db.commit()
-        return cur.lastrowid
+        return _global_id(cur.lastrowid, shard)
 
 async def list_reminders_for_chat(telegram_id):
-    async with aiosqlite.connect(DB) as db:
+    shard = shard_of(telegram_id)
+    async with aiosqlite.connect(shard_path(shard)) as db:
         cur = await db.execute('SELECT r.id, r.title, r.time, r.recurring FROM reminders r JOIN users u ON r.user_id=u.id WHERE u.telegram_id=? ORDER BY r.time', (telegram_id,))
         rows = await cur.fetchall()
-        return [dict(id=r[0], title=r[1], time=r[2], recurring=r[3]) for r in rows]
+        return [dict(id=_global_id(r[0], shard), title=r[1], time=r[2], recurring=r[3]) for r in rows]
 
-async def delete_reminder(reminder_id):
-    async with aiosqlite.connect(DB) as db:
-        await db.execute('DELETE FROM reminders WHERE id=?', (reminder_id,))
+async def delete_reminder(reminder_id, telegram_id):
+    # only deletes a reminder owned by telegram_id; stale or foreign ids are a no-op
+    shard, local_id = _split_id(reminder_id)
+    if shard != shard_of(telegram_id):
+        return False
+    async with aiosqlite.connect(shard_path(shard)) as db:
+        cur = await db.execute('DELETE FROM reminders WHERE id=? AND user_id=(SELECT id FROM users WHERE telegram_id=?)', (local_id, telegram_id))
         await db.commit()
+        return cur.rowcount > 0
+
+DUE_SQL = '''SELECT r.id, r.title, r.time, r.recurring, u.telegram_id, u.language, u.voice_enabled, u.timezone
+FROM reminders r JOIN users u ON r.user_id=u.id WHERE {}'''
+DUE_MATCH = "(r.time=? AND COALESCE(u.timezone, ?)=?)"
+
+@functools.lru_cache(maxsize=None)
+def _zone(name):
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        log.warning("Unknown timezone %r, using %s", name, DEFAULT_TIMEZONE)
+        return pytz.timezone(DEFAULT_TIMEZONE)
+
+async def _due_in_shard(shard, moment):
+    async with aiosqlite.connect(shard_path(shard)) as db:
+        # one (local HH:MM, timezone) pair per timezone present in the shard
+        cur = await db.execute("SELECT DISTINCT COALESCE(timezone, ?) FROM users", (DEFAULT_TIMEZONE,))
+        zones = [r[0] for r in await cur.fetchall()]
+        if not zones:
+            return []
+        args = []
+        for name in zones:
+            args += [moment.astimezone(_zone(name)).strftime("%H:%M"), DEFAULT_TIMEZONE, name]
+        cur = await db.execute(DUE_SQL.format(" OR ".join([DUE_MATCH] * len(zones))), args)
+        rows = await cur.fetchall()
+        return [dict(id=_global_id(r[0], shard), title=r[1], time=r[2], recurring=r[3], telegram_id=r[4],
+                     language=r[5], voice_enabled=bool(r[6]), timezone=r[7] or DEFAULT_TIMEZONE) for r in rows]
+
+async def list_due_reminders(moment):
+    # reminders whose HH:MM is the current minute in their user's timezone; moment is an aware datetime.
+    # Every shard is queried in parallel and the results merged.
+    parts = await asyncio.gather(*(_due_in_shard(i, moment) for i in range(DB_SHARDS)))
+    return [r for part in parts for r in part]
 
 async def get_user_prefs(telegram_id):
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         cur = await db.execute("SELECT language, voice_enabled FROM users WHERE telegram_id=?", (telegram_id,))
         row = await cur.fetchone()
         if not row:
@@ -101,9 +175,87 @@ async def get_user_prefs(telegram_id):
         return row[0], row[1]
 
 async def set_user_prefs(telegram_id, language=None, voice_enabled=None):
-    async with aiosqlite.connect(DB) as db:
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
         if language is not None:
             await db.execute("UPDATE users SET language=? WHERE telegram_id=?", (language, telegram_id))
         if voice_enabled is not None:
             await db.execute("UPDATE users SET voice_enabled=? WHERE telegram_id=?", (1 if voice_enabled else 0, telegram_id))
         await db.commit()
+
+# per-update context: one joined read up front, one write transaction at the end
+class UpdateContext:
+    def __init__(self, telegram_id, user_id, language, voice_enabled, state, temp_data, reminder_count):
+        self.telegram_id = telegram_id
+        self.user_id = user_id
+        self.language = language or 'uz'
+        self.voice_enabled = bool(voice_enabled)
+        self.state = state
+        self.temp_data = temp_data
+        self.reminder_count = reminder_count
+        self.new_reminders = []
+        self._dirty = set()
+
+    def set_state(self, state, temp_data=None):
+        self.state, self.temp_data = state, temp_data
+        self._dirty.add('state')
+
+    def clear_state(self):
+        self.set_state(None, None)
+
+    def set_prefs(self, language=None, voice_enabled=None):
+        if language is not None:
+            self.language = language
+            self._dirty.add('language')
+        if voice_enabled is not None:
+            self.voice_enabled = bool(voice_enabled)
+            self._dirty.add('voice_enabled')
+
+    def add_reminder(self, title, time_str, recurring=None):
+        self.new_reminders.append((title, time_str, recurring))
+        self.reminder_count += 1
+
+    async def flush(self):
+        await save_context(self)
+
+CONTEXT_SQL = '''SELECT u.id, u.language, u.voice_enabled, s.state, s.temp_data,
+    (SELECT COUNT(*) FROM reminders r WHERE r.user_id=u.id)
+FROM users u LEFT JOIN user_state s ON s.user_id=u.id WHERE u.telegram_id=?'''
+
+async def load_context(telegram_id, name=None):
+    # no chat (e.g. a callback on an inline message): never create a user row with a NULL telegram_id
+    if telegram_id is None:
+        return None
+    async with aiosqlite.connect(db_for(telegram_id)) as db:
+        cur = await db.execute(CONTEXT_SQL, (telegram_id,))
+        row = await cur.fetchone()
+        if not row:
+            now = datetime.datetime.utcnow().isoformat()
+            await db.execute("INSERT OR IGNORE INTO users (telegram_id,name,timezone,created_at) VALUES (?,?,?,?)", (telegram_id, name or '', DEFAULT_TIMEZONE, now))
+            await db.commit()
+            cur = await db.execute(CONTEXT_SQL, (telegram_id,))
+            row = await cur.fetchone()
+    td = json.loads(row[4]) if row[4] else None
+    return UpdateContext(telegram_id, row[0], row[1], row[2], row[3], td, row[5])
+
+async def save_context(ctx):
+    if not (ctx._dirty or ctx.new_reminders):
+        return
+    now = datetime.datetime.utcnow().isoformat()
+    async with aiosqlite.connect(db_for(ctx.telegram_id)) as db:
+        # only the changed columns, so concurrent updates to the other pref are not overwritten
+        if 'language' in ctx._dirty:
+            await db.execute("UPDATE users SET language=? WHERE id=?", (ctx.language, ctx.user_id))
+        if 'voice_enabled' in ctx._dirty:
+            await db.execute("UPDATE users SET voice_enabled=? WHERE id=?", (1 if ctx.voice_enabled else 0, ctx.user_id))
+        if 'state' in ctx._dirty:
+            if ctx.state is None:
+                await db.execute("DELETE FROM user_state WHERE user_id=?", (ctx.user_id,))
+            else:
+                td = json.dumps(ctx.temp_data) if ctx.temp_data is not None else None
+                await db.execute("INSERT OR REPLACE INTO user_state (user_id,state,temp_data,updated_at) VALUES (?,?,?,?)", (ctx.user_id, ctx.state, td, now))
+        if ctx.new_reminders:
+            await db.executemany("INSERT INTO reminders (user_id,title,time,recurring,created_at) VALUES (?,?,?,?,?)",
+                                 [(ctx.user_id, t, tm, rec, now) for t, tm, rec in ctx.new_reminders])
+        await db.commit()
+    ctx._dirty.clear()
+    ctx.new_reminders = []
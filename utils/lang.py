@@ -13,7 +13,8 @@ TEXT = {
         "lang_set": "Til o'zgartirildi: {lang}",
         "voice_on": "🔊 Ovozli eslatmalar yoqildi",
         "voice_off": "🔇 Ovozli eslatmalar o'chirildi",
-        "confirm_delete": "Dori oʻchirildi."
+        "confirm_delete": "Dori oʻchirildi.",
+        "reminder": "⏰ Dori vaqti bo‘ldi: {title} ({time})"
     },
     "ru": {
         "greeting": "👋 Здравствуйте! Добро пожаловать в бот напоминаний о лекарствах!",
@@ -29,6 +30,7 @@ TEXT = {
         "lang_set": "Язык изменён: {lang}",
         "voice_on": "🔊 Голосовые уведомления включены",
         "voice_off": "🔇 Голосовые уведомления отключены",
-        "confirm_delete": "Напоминание удалено."
+        "confirm_delete": "Напоминание удалено.",
+        "reminder": "⏰ Пора принять лекарство: {title} ({time})"
     }
 }
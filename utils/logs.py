@@ -0,0 +1,127 @@
+import os, copy, json, time, glob, queue, atexit, logging, contextvars
+import logging.handlers
+from datetime import datetime
+
+LOG_FILE = os.getenv("LOG_FILE", "pillbot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 5 * 1024 * 1024))
+LOG_ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS", 24))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 10))
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", 7))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+# correlation ids of the update being handled; asyncio tasks inherit them on creation
+update_id_var = contextvars.ContextVar("update_id", default=None)
+chat_id_var = contextvars.ContextVar("chat_id", default=None)
+
+def bind(update_id=None, chat_id=None):
+    update_id_var.set(update_id)
+    chat_id_var.set(chat_id)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        doc = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("update_id", "chat_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                doc[key] = value
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    # size-based rotation that also rolls the file over once it is max_age seconds old
+    def __init__(self, filename, max_bytes, backups, max_age):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.max_age = max_age
+        self.opened_at = self._started_at()
+
+    def _started_at(self):
+        # survive restarts: the newest backup was closed at the last rollover; else use the live file
+        for path in (f"{self.baseFilename}.1", self.baseFilename):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                pass
+        return time.time()
+
+    def shouldRollover(self, record):
+        if self.max_age and time.time() - self.opened_at >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+class _ContextFilter(logging.Filter):
+    # runs in the caller so the contextvars of the current update are still visible
+    def filter(self, record):
+        if not hasattr(record, "update_id"):
+            record.update_id = update_id_var.get()
+        if not hasattr(record, "chat_id"):
+            record.chat_id = chat_id_var.get()
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # never blocks the caller: JSON formatting happens in the listener thread, and a full queue drops records
+    dropped = 0
+
+    def prepare(self, record):
+        # snapshot the message now; args may be live objects the caller keeps mutating
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener = None
+_queue_handler = None
+
+def setup_logging():
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+    formatter = JsonFormatter()
+    file_handler = RotatingLogHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_ROTATE_HOURS * 3600)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = _QueueHandler(q)
+    _queue_handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    _listener = logging.handlers.QueueListener(q, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+def dropped_records():
+    return _queue_handler.dropped if _queue_handler else 0
+
+def cleanup(retention_days=LOG_RETENTION_DAYS):
+    # delete rotated files past retention; returns the removed paths
+    cutoff = time.time() - retention_days * 86400
+    removed = []
+    for path in glob.glob(f"{LOG_FILE}.*"):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed.append(path)
+        except OSError:
+            pass
+    return removed
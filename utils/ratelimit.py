@@ -0,0 +1,38 @@
+import os, asyncio
+
+# process-wide budget for bulk Bot API traffic (broadcasts, reminder dispatch). Telegram allows
+# ~30 messages/second per bot; the default leaves headroom for interactive replies.
+BOT_API_RATE = float(os.getenv("BOT_API_RATE", os.getenv("BROADCAST_RATE", 25)))
+
+class RateLimiter:
+    # spaces calls 1/rate apart across all callers; pause() honours 429 retry_after
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            delay = self.next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_at = max(loop.time(), self.next_at) + self.interval
+
+    def pause(self, seconds):
+        self.next_at = max(self.next_at, asyncio.get_running_loop().time() + seconds)
+
+bot_limiter = RateLimiter(BOT_API_RATE)
+
+MAX_RETRIES = int(os.getenv("BOT_API_RETRIES", 5))
+
+async def limited_call(call, limiter=bot_limiter, retries=MAX_RETRIES):
+    # call() performs one Bot API request and returns its JSON; a 429 pauses the limiter for retry_after and retries
+    data = {}
+    for _ in range(retries):
+        await limiter.wait()
+        data = await call()
+        if data.get("error_code") != 429:
+            return data
+        limiter.pause(data.get("parameters", {}).get("retry_after", 1))
+    return data
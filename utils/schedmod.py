@@ -1,9 +1,16 @@
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-import logging
+from datetime import datetime, timedelta
+import asyncio, logging, os
+import pytz
+from . import dbmod
 log = logging.getLogger("pillbot.scheduler")
 sched = AsyncIOScheduler()
+TZ = pytz.timezone(dbmod.DEFAULT_TIMEZONE)
+# a late or skipped tick dispatches the minutes it missed, up to this many
+MAX_CATCHUP_MINUTES = int(os.getenv("MAX_CATCHUP_MINUTES", 30))
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", 16))
 
 def start_scheduler():
     if not sched.running:
@@ -22,8 +29,71 @@ def schedule_ping(interval_minutes, func, args=()):
     except Exception as e:
         log.exception("Failed to schedule ping: %s", e)
 
+def schedule_dispatch(func):
+    # func runs at second 0 of every minute; overlapping runs are coalesced
+    try:
+        sched.add_job(func, CronTrigger(second=0), id='dispatch', replace_existing=True,
+                      max_instances=1, coalesce=True, misfire_grace_time=30)
+    except Exception as e:
+        log.exception("Failed to schedule dispatch: %s", e)
+
 def remove_job(job_id):
     try:
         sched.remove_job(job_id)
     except Exception:
         pass
+
+# clocks: the dispatcher only reads time through one of these
+class SystemClock:
+    def now(self):
+        return datetime.now(TZ)
+
+class VirtualClock:
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def set(self, moment):
+        self.current = moment
+
+    def advance(self, **kwargs):
+        self.current += timedelta(**kwargs)
+
+class Dispatcher:
+    # sends every reminder due at HH:MM exactly once per minute, catching up on late ticks
+    def __init__(self, send, clock=None, due=None):
+        self.send = send
+        self.clock = clock or SystemClock()
+        self.due = due or dbmod.list_due_reminders
+        self.last_minute = None
+        self.limit = asyncio.Semaphore(DISPATCH_CONCURRENCY)
+
+    def _pending_minutes(self, now):
+        if self.last_minute is None:
+            return [now]
+        if now <= self.last_minute:
+            return []
+        gap = int((now - self.last_minute).total_seconds() // 60)
+        if gap > MAX_CATCHUP_MINUTES:
+            log.warning("Dispatcher fell %d minutes behind; only the last %d are replayed", gap, MAX_CATCHUP_MINUTES)
+            gap = MAX_CATCHUP_MINUTES
+        return [now - timedelta(minutes=i) for i in range(gap - 1, -1, -1)]
+
+    async def _send_one(self, reminder):
+        async with self.limit:
+            try:
+                await self.send(reminder)
+            except Exception as e:
+                log.warning("Reminder %s dispatch failed: %s", reminder.get("id"), e)
+
+    async def tick(self):
+        now = self.clock.now().replace(second=0, microsecond=0)
+        sent = 0
+        for minute in self._pending_minutes(now):
+            due = await self.due(minute)
+            await asyncio.gather(*(self._send_one(r) for r in due))
+            sent += len(due)
+            self.last_minute = minute
+        return sent
@@ -0,0 +1,51 @@
+import os, sqlite3
+from . import dbmod
+
+def reshard(src_paths, shards, pattern=None):
+    # copy users, reminders and state from src_paths into `shards` hash shards; returns row counts.
+    # Rows get new local ids, so every reminder id (as shown in show_meds / delete_<id>) is renumbered.
+    pattern = pattern or dbmod.DB_SHARD_PATTERN
+    dest_paths = [dbmod.DB if shards == 1 else pattern.format(shard=i) for i in range(shards)]
+    if set(map(os.path.abspath, dest_paths)) & set(map(os.path.abspath, src_paths)):
+        raise ValueError("destination shards must not overlap the source databases")
+    dests = []
+    for p in dest_paths:
+        os.makedirs(os.path.dirname(p) or '.', exist_ok=True)
+        conn = sqlite3.connect(p)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(dbmod.SCHEMA)
+        dests.append(conn)
+    counts = dict(users=0, reminders=0, states=0, orphans=0)
+    for src_path in src_paths:
+        if not os.path.exists(src_path):
+            continue
+        src = sqlite3.connect(src_path)
+        moved = {}  # old user id -> (shard, new user id)
+        for uid, tid, name, language, voice_enabled, tz, created in src.execute(
+                'SELECT id, telegram_id, name, language, voice_enabled, timezone, created_at FROM users'):
+            shard = dbmod.shard_of(tid, shards)
+            cur = dests[shard].execute('INSERT INTO users (telegram_id,name,language,voice_enabled,timezone,created_at) VALUES (?,?,?,?,?,?)',
+                                       (tid, name, language, voice_enabled, tz, created))
+            moved[uid] = (shard, cur.lastrowid)
+            counts['users'] += 1
+        for uid, title, time_str, recurring, created in src.execute('SELECT user_id, title, time, recurring, created_at FROM reminders'):
+            if uid not in moved:
+                counts['orphans'] += 1
+                continue
+            shard, new_uid = moved[uid]
+            dests[shard].execute('INSERT INTO reminders (user_id,title,time,recurring,created_at) VALUES (?,?,?,?,?)',
+                                 (new_uid, title, time_str, recurring, created))
+            counts['reminders'] += 1
+        for uid, state, temp_data, updated in src.execute('SELECT user_id, state, temp_data, updated_at FROM user_state'):
+            if uid not in moved:
+                counts['orphans'] += 1
+                continue
+            shard, new_uid = moved[uid]
+            dests[shard].execute('INSERT OR REPLACE INTO user_state (user_id,state,temp_data,updated_at) VALUES (?,?,?,?)',
+                                 (new_uid, state, temp_data, updated))
+            counts['states'] += 1
+        src.close()
+    for conn in dests:
+        conn.commit()
+        conn.close()
+    return counts
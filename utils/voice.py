@@ -1,18 +1,124 @@
+import os, io, time, shutil, asyncio, logging, subprocess, functools
+from concurrent.futures import ThreadPoolExecutor
 
-from gtts import gTTS
-import time, os
+log = logging.getLogger("pillbot.voice")
 VOICE_DIR = "voice"
 os.makedirs(VOICE_DIR, exist_ok=True)
+
+# backend order, e.g. TTS_BACKENDS="espeak,gtts" and per language TTS_LANG_BACKENDS="ru=gtts,espeak;uz=espeak"
+TTS_BACKENDS = os.getenv("TTS_BACKENDS", "espeak,gtts")
+TTS_LANG_BACKENDS = os.getenv("TTS_LANG_BACKENDS", "")
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", 4))
+ESPEAK_BIN = os.getenv("ESPEAK_BIN") or shutil.which("espeak-ng") or shutil.which("espeak")
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or shutil.which("ffmpeg")
+# Telegram voice notes are OGG/Opus; low-bitrate mono is plenty for speech
+VOICE_BITRATE = os.getenv("VOICE_BITRATE", "24k")
+MIME = {"ogg": "audio/ogg", "mp3": "audio/mpeg"}
+# trim leading/trailing silence (reverse trick keeps pauses inside the phrase), then EBU R128 loudness
+VOICE_FILTER = ("silenceremove=start_periods=1:start_threshold=-50dB,areverse,"
+                "silenceremove=start_periods=1:start_threshold=-50dB,areverse,"
+                "loudnorm=I=-16:TP=-1.5:LRA=11")
+
+# synthesis runs here so the event loop never waits on HTTP or a subprocess
+_pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+def _run(cmd, data, timeout=20):
+    res = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if res.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(cmd[0])} exited {res.returncode}: {res.stderr.decode(errors='replace').strip()}")
+    return res.stdout
+
+def to_opus(audio, fmt):
+    # single ffmpeg pass over pipes: decode, trim, normalize, encode mono Opus in an OGG container
+    return _run([FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-f", fmt, "-i", "pipe:0",
+                 "-af", VOICE_FILTER, "-ac", "1", "-ar", "48000",
+                 "-c:a", "libopus", "-b:a", VOICE_BITRATE, "-application", "voip",
+                 "-f", "ogg", "pipe:1"], audio)
+
+def postprocess(audio, fmt):
+    # returns (bytes, ext); without ffmpeg only MP3 can be sent as a voice note
+    if FFMPEG_BIN:
+        try:
+            return to_opus(audio, fmt), "ogg"
+        except Exception as e:
+            log.warning("Opus encoding failed, sending %s as is: %s", fmt, e)
+    if fmt != "mp3":
+        raise RuntimeError(f"Cannot send {fmt} audio without ffmpeg")
+    return audio, "mp3"
+
+class GTTSBackend:
+    # remote: one HTTPS request to Google per phrase
+    name = "gtts"
+    fmt = "mp3"
+
+    @functools.lru_cache(maxsize=None)
+    def available(self, lang):
+        try:
+            from gtts.lang import tts_langs
+            return lang in tts_langs()
+        except Exception:
+            return False
+
+    def synthesize(self, text, lang):
+        from gtts import gTTS
+        buf = io.BytesIO()
+        gTTS(text=text, lang=lang).write_to_fp(buf)
+        return buf.getvalue()
+
+class EspeakBackend:
+    # local: espeak-ng renders WAV to stdout, no network involved
+    name = "espeak"
+    fmt = "wav"
+    VOICES = {"uz": "uz", "ru": "ru", "en": "en-us"}
+
+    @functools.lru_cache(maxsize=None)
+    def available(self, lang):
+        if not (ESPEAK_BIN and FFMPEG_BIN):
+            return False
+        try:
+            out = _run([ESPEAK_BIN, f"--voices={lang}"], b"", timeout=5).decode(errors="replace")
+        except Exception:
+            return False
+        return len(out.strip().splitlines()) > 1
+
+    def synthesize(self, text, lang):
+        return _run([ESPEAK_BIN, "-v", self.VOICES.get(lang, lang), "--stdout", "--stdin"], text.encode("utf-8"))
+
+BACKENDS = {b.name: b for b in (EspeakBackend(), GTTSBackend())}
+
+def _parse_order(spec):
+    return [n.strip() for n in spec.split(",") if n.strip()]
+
+LANG_ORDER = {}
+for item in TTS_LANG_BACKENDS.split(";"):
+    if "=" in item:
+        code, spec = item.split("=", 1)
+        LANG_ORDER[code.strip()] = _parse_order(spec)
+
+def backends_for(lang):
+    order = LANG_ORDER.get(lang) or _parse_order(TTS_BACKENDS)
+    return [BACKENDS[n] for n in order if n in BACKENDS and BACKENDS[n].available(lang)]
+
+def render(text, lang='uz'):
+    # synthesize + post-process entirely in memory; returns (bytes, ext). A backend whose audio
+    # cannot be encoded counts as failed too, so the next backend is tried.
+    last = None
+    for backend in backends_for(lang):
+        try:
+            return postprocess(backend.synthesize(text, lang), backend.fmt)
+        except Exception as e:
+            log.warning("TTS backend %s failed for %s: %s", backend.name, lang, e)
+            last = e
+    raise RuntimeError(f"No TTS backend could synthesize lang={lang}") from last
+
+async def render_async(text, lang='uz'):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, render, text, lang)
+
 def text_to_speech(text, lang='uz'):
-    fn = f"tts_{int(time.time())}.mp3"
+    audio, ext = render(text, lang)
+    fn = f"tts_{time.time_ns()}.{ext}"
     path = os.path.join(VOICE_DIR, fn)
-    tts = gTTS(text=text, lang=lang)
-    tts.save(path)
+    with open(path, "wb") as f:
+        f.write(audio)
     return path
-def cleanup_old(limit=100):
-    files = sorted([os.path.join(VOICE_DIR,f) for f in os.listdir(VOICE_DIR)], key=os.path.getmtime)
-    while len(files) > limit:
-        try:
-            os.remove(files.pop(0))
-        except Exception:
-            break
@@ -1,24 +1,30 @@
 
 import os, asyncio, logging, json, aiosqlite, time
 from datetime import datetime
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
 import aiohttp, uvicorn
 
-from utils import dbmod, schedmod, ui, voice, lang
+from utils import dbmod, schedmod, ui, voice, lang, logs, broadcast, ratelimit
 import bot_handlers
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logs.setup_logging()
 log = logging.getLogger("pillbot.webhook")
 logging.getLogger("uvicorn.access").setLevel(logging.INFO)
 
 # Config
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_CHAT = os.getenv("ADMIN_CHAT", "")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 BASE_URL = os.getenv("BASE_URL", "https://pillbot-4-6.onrender.com")
 WEBHOOK_URL = f"{BASE_URL}/webhook"
 ENABLE_VOICE = os.getenv("ENABLE_VOICE", "True").lower() in ("1","true","yes")
 VOICE_LANG = os.getenv("VOICE_LANG", "uz")
 PORT = int(os.getenv("PORT", 10000))
+# answer the first Bot API call of an update inside the webhook HTTP response
+INLINE_REPLY = os.getenv("INLINE_REPLY", "True").lower() in ("1","true","yes")
+INLINE_REPLY_TIMEOUT = float(os.getenv("INLINE_REPLY_TIMEOUT", 1.5))
+# upper bound on holding later calls back when the webhook response is never confirmed sent
+INLINE_FLUSH_TIMEOUT = float(os.getenv("INLINE_FLUSH_TIMEOUT", 10))
 
 if not TOKEN:
     raise RuntimeError("Missing TELEGRAM_TOKEN environment variable")
@@ -42,28 +48,113 @@ async def root():
 async def ping():
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
 
-async def send_message(chat_id, text, reply_markup=None):
+def message_payload(chat_id, text, reply_markup=None):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup is not None:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
-    try:
+    return payload
+
+async def _bot_post(method, limiter=None, timeout=10, payload=None, form=None):
+    # one Bot API call returning its JSON; with a limiter it is paced and 429s are retried
+    async def call():
+        kwargs = {"json": payload} if form is None else {"data": form()}
         async with aiohttp.ClientSession() as session:
-            await session.post(f"{BOT_API}/sendMessage", json=payload, timeout=10)
+            async with session.post(f"{BOT_API}/{method}", timeout=timeout, **kwargs) as resp:
+                return await resp.json(content_type=None)
+    if limiter is None:
+        return await call()
+    return await ratelimit.limited_call(call, limiter)
+
+async def send_message(chat_id, text, reply_markup=None, limiter=None):
+    payload = message_payload(chat_id, text, reply_markup)
+    try:
+        data = await _bot_post("sendMessage", limiter, payload=payload)
     except Exception as e:
         log.warning("send_message failed: %s", e)
+        return False
+    if not data.get("ok"):
+        log.warning("send_message to %s rejected: %s", chat_id, data.get("description"))
+    return bool(data.get("ok"))
 
-async def send_voice(chat_id, text, lang_code="uz"):
+async def send_voice(chat_id, text, lang_code="uz", limiter=None):
     try:
-        mp3 = voice.text_to_speech(text, lang=lang_code)
-        async with aiohttp.ClientSession() as session:
-            with open(mp3, "rb") as f:
-                data = aiohttp.FormData()
-                data.add_field("chat_id", str(chat_id))
-                data.add_field("voice", f, filename="tts.mp3", content_type="audio/mpeg")
-                await session.post(f"{BOT_API}/sendVoice", data=data, timeout=20)
-        voice.cleanup_old()
+        audio, ext = await voice.render_async(text, lang=lang_code)
+        def form():
+            # rebuilt per attempt; aiohttp cannot resend a FormData
+            data = aiohttp.FormData()
+            data.add_field("chat_id", str(chat_id))
+            data.add_field("voice", audio, filename=f"tts.{ext}", content_type=voice.MIME[ext])
+            return data
+        data = await _bot_post("sendVoice", limiter, timeout=20, form=form)
     except Exception as e:
         log.warning("send_voice failed: %s", e)
+        return False
+    if not data.get("ok"):
+        log.warning("send_voice to %s rejected: %s", chat_id, data.get("description"))
+    return bool(data.get("ok"))
+
+class InlineReply:
+    # Captures the first sendMessage of a handler so webhook() can return it as the HTTP
+    # response body; every later call goes over the outbound client once that response is out.
+    def __init__(self):
+        self.call = None
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.flushed = asyncio.Event()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def flush(self):
+        self.flushed.set()
+
+    async def _after_response(self):
+        # flush() runs as a background task, which never happens if sending the response fails
+        if self.call is None:
+            return
+        try:
+            await asyncio.wait_for(self.flushed.wait(), INLINE_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("Inline reply not confirmed within %.0fs; sending remaining calls anyway", INLINE_FLUSH_TIMEOUT)
+            self.flushed.set()
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if not self.closed:
+            self.call = dict(message_payload(chat_id, text, reply_markup), method="sendMessage")
+            self.close()
+            return
+        await self._after_response()
+        await send_message(chat_id, text, reply_markup=reply_markup)
+
+    async def send_voice(self, chat_id, text, lang_code="uz"):
+        self.close()
+        await self._after_response()
+        await send_voice(chat_id, text, lang_code=lang_code)
+
+_handler_tasks = set()
+
+def _run_handler(handler, *args):
+    task = asyncio.create_task(handler(*args))
+    _handler_tasks.add(task)
+    def done(t):
+        _handler_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            log.error("Handler %s failed", handler.__name__, exc_info=t.exception())
+    task.add_done_callback(done)
+    return task
+
+async def send_reminder(reminder):
+    lang_code = reminder.get("language") or "uz"
+    T = lang.TEXT.get(lang_code, lang.TEXT["uz"])
+    text = T["reminder"].format(title=reminder["title"], time=reminder["time"])
+    # bulk traffic: paced by the shared limiter so preset-time peaks stay under Telegram's limits
+    if not await send_message(reminder["telegram_id"], text, limiter=ratelimit.bot_limiter):
+        raise RuntimeError(f"reminder {reminder['id']} not delivered")
+    if ENABLE_VOICE and reminder.get("voice_enabled"):
+        await send_voice(reminder["telegram_id"], text, lang_code=lang_code, limiter=ratelimit.bot_limiter)
+
+dispatcher = schedmod.Dispatcher(send_reminder)
 
 # Webhook maintenance
 async def ensure_webhook_once():
@@ -99,16 +190,17 @@ async def self_ping_once():
         log.warning("Self-ping failed: %s", e)
 
 async def cleanup_logs():
-    # Keep only latest N log files in /tmp (if your app writes them) - here placeholder
-    # This function scheduled daily to avoid log bloat
-    log.info("cleanup_logs: placeholder (nothing to delete in this environment)")
+    # enforce LOG_RETENTION_DAYS on rotated files; runs off the event loop
+    removed = await asyncio.to_thread(logs.cleanup)
+    log.info("cleanup_logs: removed %d rotated log files, %d records dropped so far", len(removed), logs.dropped_records())
 
 async def schedule_keepalive():
     try:
         schedmod.start_scheduler()
         schedmod.schedule_ping(14, self_ping_once)
+        schedmod.schedule_dispatch(dispatcher.tick)
         # schedule daily cleanup
-        schedmod.sched.add_job(lambda: asyncio.ensure_future(cleanup_logs()), 'interval', hours=24, id='cleanup_logs', replace_existing=True)
+        schedmod.sched.add_job(cleanup_logs, 'interval', hours=24, id='cleanup_logs', replace_existing=True)
     except Exception as e:
         log.warning("schedule_keepalive error: %s", e)
 
@@ -116,28 +208,92 @@ async def schedule_keepalive():
 @app.post("/webhook")
 async def webhook(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
+    chat = (data.get("message") or data.get("callback_query", {}).get("message") or {}).get("chat", {})
+    logs.bind(update_id=data.get("update_id"), chat_id=chat.get("id"))
     log.debug("Incoming update raw: %s", data)
     try:
         # messages
         if "message" in data:
-            # delegate to handler in background
-            background_tasks.add_task(bot_handlers.handle_message, data, send_message, send_voice)
+            if INLINE_REPLY:
+                # give the handler a short head start; its first reply rides on this response
+                reply = InlineReply()
+                task = _run_handler(bot_handlers.handle_message, data, reply.send_message, reply.send_voice)
+                task.add_done_callback(lambda _: reply.close())
+                try:
+                    await asyncio.wait_for(reply.ready.wait(), INLINE_REPLY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                reply.close()
+                background_tasks.add_task(reply.flush)
+                if reply.call is not None:
+                    return reply.call
+            else:
+                background_tasks.add_task(bot_handlers.handle_message, data, send_message, send_voice)
         # callback_query
         if "callback_query" in data:
             cq = data["callback_query"]
             cid = cq.get("id")
-            # immediately answer callback to remove client spinner
+            # delegate handling to background
+            background_tasks.add_task(bot_handlers.handle_callback, cq, send_message, send_voice)
+            # answer callback to remove client spinner
+            if INLINE_REPLY:
+                return {"method": "answerCallbackQuery", "callback_query_id": cid}
             try:
                 async with aiohttp.ClientSession() as sess:
                     await sess.post(f"{BOT_API}/answerCallbackQuery", json={"callback_query_id": cid}, timeout=5)
             except Exception as e:
                 log.warning("answerCallbackQuery failed: %s", e)
-            # delegate handling to background
-            background_tasks.add_task(bot_handlers.handle_callback, cq, send_message, send_voice)
     except Exception as e:
         log.exception("Webhook processing error: %s", e)
     return {"ok": True}
 
+# Admin broadcast (header X-Admin-Token must match ADMIN_TOKEN)
+def _check_admin(request):
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="forbidden")
+
+@app.post("/admin/broadcast")
+async def admin_broadcast(request: Request):
+    # body: {"text": "..." or {"uz": "...", "ru": "..."}, "voice": bool, "language": "uz", "timezone": "Asia/Tashkent"}
+    _check_admin(request)
+    body = await request.json()
+    if not body.get("text"):
+        raise HTTPException(status_code=400, detail="text is required")
+    job = broadcast.create_job(body["text"], with_voice=body.get("voice", False),
+                               language=body.get("language"), timezone=body.get("timezone"))
+    broadcast.start(job, BOT_API)
+    log.info("Broadcast %s queued (language=%s timezone=%s voice=%s)", job["id"], job["language"], job["timezone"], job["voice"])
+    return {"ok": True, "job": job}
+
+@app.get("/admin/broadcast")
+async def admin_broadcast_list(request: Request):
+    _check_admin(request)
+    return {"ok": True, "jobs": broadcast.list_jobs()}
+
+@app.get("/admin/broadcast/{job_id}")
+async def admin_broadcast_progress(job_id: str, request: Request):
+    _check_admin(request)
+    job = broadcast.progress(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="unknown job")
+    return {"ok": True, "job": job}
+
+@app.post("/admin/broadcast/{job_id}/cancel")
+async def admin_broadcast_cancel(job_id: str, request: Request):
+    _check_admin(request)
+    return {"ok": broadcast.cancel(job_id)}
+
+@app.post("/admin/broadcast/{job_id}/resume")
+async def admin_broadcast_resume(job_id: str, request: Request):
+    _check_admin(request)
+    job = broadcast.load_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="unknown job")
+    if job["status"] != "done":
+        job["status"] = "running"
+        job = broadcast.start(job, BOT_API).job
+    return {"ok": True, "job": job}
+
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(initialize_app())
@@ -145,7 +301,7 @@ async def startup_event():
 async def initialize_app():
     log.info("Initializing PillBot 4.6 (Stable Webhook)...")
     try:
-        await dbmod.ensure_schema(path="data/pillbot.db")
+        await dbmod.ensure_schema()
     except Exception as e:
         log.warning("DB ensure_schema failed: %s", e)
     try:
@@ -154,6 +310,8 @@ async def initialize_app():
         log.warning("schedule_keepalive failed: %s", e)
     asyncio.create_task(ensure_webhook_once())
     asyncio.create_task(periodic_webhook_check())
+    for job in broadcast.resume_all(BOT_API):
+        log.info("Resuming broadcast %s", job["id"])
     # notify admin if set
     if ADMIN_CHAT:
         try:
@@ -166,4 +324,4 @@ async def initialize_app():
 
 if __name__ == "__main__":
     log.info("Starting Uvicorn: PillBot 4.6 (Webhook Stable) on port %s", PORT)
-    uvicorn.run("webhook_app:app", host="0.0.0.0", port=PORT, log_level="info")
+    uvicorn.run("webhook_app:app", host="0.0.0.0", port=PORT, log_level="info", log_config=None)